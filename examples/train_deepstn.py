@@ -1,10 +1,15 @@
 import os
 import time
+import threading
 import numpy as np
 import torch
-from torch.utils.data import DataLoader
-from torch.utils.data.sampler import SubsetRandomSampler
+from torch.utils.data import DataLoader, Subset
+from torch.utils.data.sampler import RandomSampler, SequentialSampler, BatchSampler
+from torch.utils.data.distributed import DistributedSampler
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
 import torch.nn as nn
+import torch.nn.functional as F
 from geotorchai.models.grid import DeepSTN
 from geotorchai.datasets.grid import BikeNYCDeepSTN
 
@@ -21,7 +26,8 @@ nb_area = 81
 epoch_nums = 10
 learning_rate = 0.0002
 batch_size = 32
-params = {'batch_size': batch_size, 'shuffle': False, 'drop_last':False, 'num_workers': 0}
+# batching is done by a BatchSampler, the dataset is indexed once per batch instead of once per sample
+params = {'batch_size': None, 'num_workers': 4, 'pin_memory': torch.cuda.is_available(), 'persistent_workers': True}
 
 validation_ratio = 0.1
 test_ratio = 0.1
@@ -37,7 +43,17 @@ LOAD_INITIAL = False
 random_seed = int(time.time())
 
 
+## Launch with torchrun --nproc_per_node=N examples/train_deepstn.py to train on N GPUs
 def createModelAndTrain():
+    distributed, rank, world_size, local_rank = _init_distributed()
+    is_main_process = rank == 0
+
+    # input shapes are fixed, so let cuDNN pick the fastest conv algorithm once and reuse it
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.set_float32_matmul_precision('high')
+
     pre_F=64
     conv_F=64
     R_N=2
@@ -63,19 +79,37 @@ def createModelAndTrain():
     val_split = int(np.floor((1 - (validation_ratio + test_ratio)) * dataset_size))
     test_split = int(np.floor((1 - test_ratio) * dataset_size))
     if shuffle_dataset:
-        np.random.seed(random_seed)
+        seed = random_seed
+        if distributed:
+            # every rank must shuffle the same way, otherwise their train/val/test splits overlap
+            seed_list = [seed]
+            dist.broadcast_object_list(seed_list, src=0)
+            seed = seed_list[0]
+        np.random.seed(seed)
         np.random.shuffle(indices)
     train_indices, val_indices, test_indices = indices[:val_split], indices[val_split:test_split], indices[test_split:]
 
-    train_sampler = SubsetRandomSampler(train_indices)
-    valid_sampler = SubsetRandomSampler(val_indices)
-    test_sampler = SubsetRandomSampler(test_indices)
-
-    training_generator = DataLoader(full_dataset, **params, sampler=train_sampler)
-    val_generator = DataLoader(full_dataset, **params, sampler=valid_sampler)
-    test_generator = DataLoader(full_dataset, **params, sampler=test_sampler)
+    train_dataset = Subset(full_dataset, train_indices)
+    # DistributedSampler pads the shards with repeated samples, so validation is sharded by striding instead
+    # and every sample is counted exactly once, same as on a single GPU
+    val_dataset = Subset(full_dataset, val_indices[rank::world_size])
+    test_dataset = Subset(full_dataset, test_indices)
 
-    if torch.cuda.is_available():
+    if distributed:
+        train_sampler = DistributedSampler(train_dataset, num_replicas=world_size, rank=rank, shuffle=True)
+    else:
+        train_sampler = RandomSampler(train_dataset)
+    valid_sampler = SequentialSampler(val_dataset)
+    test_sampler = SequentialSampler(test_dataset)
+
+    # dropping the last partial batch keeps every training batch the same shape
+    training_generator = DataLoader(train_dataset, **params, sampler=BatchSampler(train_sampler, batch_size, drop_last=True))
+    val_generator = DataLoader(val_dataset, **params, sampler=BatchSampler(valid_sampler, batch_size, drop_last=False))
+    test_generator = DataLoader(test_dataset, **params, sampler=BatchSampler(test_sampler, batch_size, drop_last=False))
+
+    if distributed:
+        device = torch.device("cuda", local_rank)
+    elif torch.cuda.is_available():
         device = torch.device("cuda")
     elif torch.backends.mps.is_available():
         device = torch.device("mps")
@@ -94,63 +128,113 @@ def createModelAndTrain():
         model.load_state_dict(torch.load(initial_checkpoint, map_location=lambda storage, loc: storage))
 
     loss_fn = nn.MSELoss()
-    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
     model.to(device)
+    if device.type == "cuda":
+        # cuDNN tensor core convolutions are fastest on NHWC
+        model.to(memory_format=torch.channels_last)
     loss_fn.to(device)
+    # created after moving the model, fused Adam requires its parameters to already be on the GPU
+    optimizer = _create_optimizer(model, device)
+    # checkpoints are saved from the eager model so that their keys don't carry the DDP or compile wrapper prefix
+    # DeepSTN registers both conv units and both residual blocks but forward only runs one of each,
+    # so DDP must not wait for gradients of the unused ones
+    train_model = DDP(model, device_ids=[local_rank], find_unused_parameters=True) if distributed else model
+    train_model = _compile_for_training(train_model, device)
+
+    use_amp = device.type == "cuda"
+    scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
 
     min_val_loss = None
+    best_state = None
+    save_thread = None
     for e in range(epoch_nums):
-        for i, sample in enumerate(training_generator):
-            X_c = sample["x_closeness"].type(torch.FloatTensor).to(device)
-            X_p = sample["x_period"].type(torch.FloatTensor).to(device)
-            X_t = sample["x_trend"].type(torch.FloatTensor).to(device)
-            t_data = sample["t_data"].type(torch.FloatTensor).to(device)
-            p_data = sample["p_data"].type(torch.FloatTensor).to(device)
-            Y_batch = sample["y_data"].type(torch.FloatTensor).to(device)
+        if distributed:
+            train_sampler.set_epoch(e)
+        prefetcher = CUDAPrefetcher(training_generator, device)
+        sample = prefetcher.next()
+        while sample is not None:
+            X_c = sample["x_closeness"]
+            X_p = sample["x_period"]
+            X_t = sample["x_trend"]
+            t_data = sample["t_data"]
+            p_data = sample["p_data"]
+            Y_batch = sample["y_data"]
 
             # Forward pass
-            outputs = model(X_c, X_p, X_t, t_data, p_data)
-            loss = loss_fn(outputs, Y_batch)
+            with torch.autocast(device.type, dtype=torch.float16, enabled=use_amp):
+                outputs = train_model(X_c, X_p, X_t, t_data, p_data)
+                loss = loss_fn(outputs, Y_batch)
 
             # Backward and optimize
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-
-        print('Epoch [{}/{}], Loss: {:.4f}'.format(e + 1, epoch_nums, loss.item()))
-
-        val_loss = get_validation_loss(model, val_generator, loss_fn, device)
-        print('Mean validation loss:', val_loss)
+            optimizer.zero_grad(set_to_none=True)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            sample = prefetcher.next()
+
+        if is_main_process:
+            print('Epoch [{}/{}], Loss: {:.4f}'.format(e + 1, epoch_nums, loss.item()))
+
+        total_val_loss, n_val_samples = get_validation_loss(model, val_generator, loss_fn, device)
+        val_totals = torch.stack((total_val_loss, torch.tensor(float(n_val_samples), device=device)))
+        if distributed:
+            # every rank must agree on val_loss so that they take the same branch below
+            dist.all_reduce(val_totals)
+        val_loss = (val_totals[0] / val_totals[1]).item()
+        if is_main_process:
+            print('Mean validation loss:', val_loss)
 
         if min_val_loss == None or val_loss < min_val_loss:
             min_val_loss = val_loss
-            torch.save(model.state_dict(), initial_checkpoint)
-            print('best model saved!')
-
-    model.load_state_dict(torch.load(initial_checkpoint, map_location=lambda storage, loc: storage))
+            if is_main_process:
+                # keep the best weights in memory and write the checkpoint in the background
+                best_state = {k: v.detach().cpu().clone() for k, v in model.state_dict().items()}
+                if save_thread is not None:
+                    save_thread.join()
+                save_thread = threading.Thread(target=torch.save, args=(best_state, initial_checkpoint))
+                save_thread.start()
+                print('saving best model...')
+
+    if distributed:
+        dist.destroy_process_group()
+    if not is_main_process:
+        return
+
+    if save_thread is not None:
+        save_thread.join()
+    model.load_state_dict(best_state)
     model.eval()
 
-    rmse_list = []
-    mse_list = []
-    mae_list = []
-    for i, sample in enumerate(test_generator):
-        X_c = sample["x_closeness"].type(torch.FloatTensor).to(device)
-        X_p = sample["x_period"].type(torch.FloatTensor).to(device)
-        X_t = sample["x_trend"].type(torch.FloatTensor).to(device)
-        t_data = sample["t_data"].type(torch.FloatTensor).to(device)
-        p_data = sample["p_data"].type(torch.FloatTensor).to(device)
-        Y_batch = sample["y_data"].type(torch.FloatTensor).to(device)
-
-        outputs = model(X_c, X_p, X_t, t_data, p_data)
-        mse, mae, rmse = compute_errors(outputs.cpu().data.numpy(), Y_batch.cpu().data.numpy())
-
-        rmse_list.append(rmse)
-        mse_list.append(mse)
-        mae_list.append(mae)
-
-    rmse = np.mean(rmse_list)
-    mse = np.mean(mse_list)
-    mae = np.mean(mae_list)
+    prefetcher = CUDAPrefetcher(test_generator, device)
+    sample = prefetcher.next()
+    if sample is not None:
+        test_model = _optimize_for_inference(model, (sample["x_closeness"], sample["x_period"], sample["x_trend"],
+                                                     sample["t_data"], sample["p_data"]))
+    with torch.inference_mode():
+        # running sums weighted by batch size, so a smaller last batch doesn't skew the means
+        total_mse = torch.zeros((), device=device)
+        total_mae = torch.zeros((), device=device)
+        n_samples = 0
+        while sample is not None:
+            X_c = sample["x_closeness"]
+            X_p = sample["x_period"]
+            X_t = sample["x_trend"]
+            t_data = sample["t_data"]
+            p_data = sample["p_data"]
+            Y_batch = sample["y_data"]
+
+            outputs = test_model(X_c, X_p, X_t, t_data, p_data)
+            mse, mae = compute_errors(outputs.detach(), Y_batch)
+
+            total_mse += mse * len(Y_batch)
+            total_mae += mae * len(Y_batch)
+            n_samples += len(Y_batch)
+            sample = prefetcher.next()
+
+    # metrics stay on the device until here, so there is a single sync for the whole test set
+    mse = total_mse.item() / n_samples
+    mae = total_mae.item() / n_samples
+    rmse = np.sqrt(mse)
 
     print("\n************************")
     print("Test DeepSTN+ model with BikeNYCDeepSTN Dataset:")
@@ -158,34 +242,126 @@ def createModelAndTrain():
     mse, mae, rmse, mae * min_max_diff / 2, rmse * min_max_diff / 2))
 
 
+def _init_distributed():
+    # torchrun sets WORLD_SIZE, RANK and LOCAL_RANK for every process it launches
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size <= 1:
+        return False, 0, 1, 0
+
+    rank = int(os.environ["RANK"])
+    local_rank = int(os.environ["LOCAL_RANK"])
+    torch.cuda.set_device(local_rank)
+    dist.init_process_group("nccl")
+    return True, rank, world_size, local_rank
+
+
+def _create_optimizer(model, device):
+    # fused Adam runs a single kernel per parameter group, it needs PyTorch 1.13+ and CUDA parameters
+    try:
+        return torch.optim.Adam(model.parameters(), lr=learning_rate, fused=device.type == "cuda")
+    except (TypeError, RuntimeError):
+        return torch.optim.Adam(model.parameters(), lr=learning_rate)
+
+
+def _compile_for_training(model, device):
+    # torch.compile is only available from PyTorch 2.0, fall back to the eager model otherwise
+    if device.type != "cuda" or not hasattr(torch, "compile"):
+        return model
+    try:
+        # compilation happens lazily on the first forward, so backend errors from Inductor/Triton
+        # surface there and not here. Let dynamo run those graphs eagerly instead of raising
+        import torch._dynamo
+        torch._dynamo.config.suppress_errors = True
+        return torch.compile(model, mode="reduce-overhead", fullgraph=False)
+    except Exception:
+        return model
+
+
+def _optimize_for_inference(model, example_inputs):
+    # model must already be in eval mode, since freezing folds dropout and batch norm
+    try:
+        traced_model = torch.jit.trace(model, example_inputs)
+        return torch.jit.optimize_for_inference(torch.jit.freeze(traced_model))
+    except Exception:
+        return model
+
+
+class CUDAPrefetcher:
+    # Copies the next batch to the device on a side stream while the current batch is being processed
+    def __init__(self, loader, device):
+        self.device = device
+        self.loader_iter = iter(loader)
+        self.stream = torch.cuda.Stream() if device.type == "cuda" else None
+        self.preload()
+
+    def preload(self):
+        try:
+            sample = next(self.loader_iter)
+        except StopIteration:
+            self.next_batch = None
+            return
+
+        if self.stream is None:
+            self.next_batch = _move(sample, self.device)
+        else:
+            with torch.cuda.stream(self.stream):
+                self.next_batch = _move(sample, self.device)
+
+    def next(self):
+        batch = self.next_batch
+        if batch is None:
+            return None
+
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_stream(self.stream)
+            for v in batch.values():
+                v.record_stream(current_stream)
+        self.preload()
+        return batch
+
+
+def _move(sample, device):
+    # non_blocking copies only overlap with compute when the source is pinned
+    # 4D grids are laid out channels_last on CUDA to match the model
+    grid_format = torch.channels_last if device.type == "cuda" else torch.preserve_format
+    return {k: v.to(device, non_blocking=True, memory_format=grid_format if v.dim() == 4 else torch.preserve_format)
+            for k, v in sample.items()}
+
+
 def compute_errors(preds, y_true):
     pred_mean = preds[:, 0:2]
-    diff = y_true - pred_mean
 
-    mse = np.mean(diff ** 2)
-    rmse = np.sqrt(mse)
-    mae = np.mean(np.abs(diff))
+    mse = F.mse_loss(pred_mean, y_true)
+    mae = F.l1_loss(pred_mean, y_true)
 
-    return mse, mae, rmse
+    # rmse is taken from the mean mse over the whole test set by the caller
+    return mse, mae
 
 
 def get_validation_loss(model, val_generator, criterion, device):
     model.eval()
-    mean_loss = []
-    for i, sample in enumerate(val_generator):
-        X_c = sample["x_closeness"].type(torch.FloatTensor).to(device)
-        X_p = sample["x_period"].type(torch.FloatTensor).to(device)
-        X_t = sample["x_trend"].type(torch.FloatTensor).to(device)
-        t_data = sample["t_data"].type(torch.FloatTensor).to(device)
-        p_data = sample["p_data"].type(torch.FloatTensor).to(device)
-        Y_batch = sample["y_data"].type(torch.FloatTensor).to(device)
-
-        outputs = model(X_c, X_p, X_t, t_data, p_data)
-        mse= criterion(outputs, Y_batch).item()
-        mean_loss.append(mse)
-
-    mean_loss = np.mean(mean_loss)
-    return mean_loss
+    with torch.inference_mode():
+        total_loss = torch.zeros((), device=device)
+        n_samples = 0
+        prefetcher = CUDAPrefetcher(val_generator, device)
+        sample = prefetcher.next()
+        while sample is not None:
+            X_c = sample["x_closeness"]
+            X_p = sample["x_period"]
+            X_t = sample["x_trend"]
+            t_data = sample["t_data"]
+            p_data = sample["p_data"]
+            Y_batch = sample["y_data"]
+
+            outputs = model(X_c, X_p, X_t, t_data, p_data)
+            total_loss += criterion(outputs, Y_batch) * len(Y_batch)
+            n_samples += len(Y_batch)
+            sample = prefetcher.next()
+
+    model.train()
+    # the sum and the count are returned separately so that they can be reduced across ranks before dividing
+    return total_loss, n_samples
 
 
 
@@ -30,25 +30,33 @@ class BikeNYCDeepSTN(Dataset):
     DATA_URL = "https://raw.githubusercontent.com/FIBLAB/DeepSTN/master/BikeNYC/DATA/dataBikeNYC/flow_data.npy"
     POI_URL = "https://raw.githubusercontent.com/FIBLAB/DeepSTN/master/BikeNYC/DATA/dataBikeNYC/poi_data.npy"
 
+    # data directories found so far, keyed by absolute root. Only hits are stored so that a miss is searched again next time
+    _data_dirs = {}
+
     def __init__(self, root, download = False, len_closeness = 3, len_period = 4, len_trend = 4, T_closeness=1, T_period=24, T_trend=24*7, normalize=True):
         super().__init__()
 
         if download:
             _download_remote_file(self.DATA_URL, root)
             _download_remote_file(self.POI_URL, root)
+            # the downloaded files may be shallower than a previously found data directory
+            BikeNYCDeepSTN._data_dirs.pop(os.path.abspath(root), None)
 
         data_dir = self._get_path(root)
 
-        flow_data = np.load(open(data_dir + "/flow_data.npy", "rb"))
-        poi_data = np.load(open(data_dir + "/poi_data.npy", "rb"))
-
-        self.full_data = np.copy(flow_data)
+        # memory-map the files, only the pages that are actually read are loaded
+        flow_data = np.load(data_dir + "/flow_data.npy", mmap_mode="r")
+        poi_data = np.load(data_dir + "/poi_data.npy", mmap_mode="r")
 
-        max_data = np.max(self.full_data)
-        min_data = np.min(self.full_data)
+        max_data = flow_data.max()
+        min_data = flow_data.min()
+        # np.array copies into a plain ndarray, astype on a memmap would keep the memmap subclass
+        self.full_data = np.array(flow_data, dtype=np.float32)
         self.min_max_diff = max_data - min_data
         if normalize:
-            self.full_data = (2.0 * self.full_data - (max_data + min_data)) / (max_data - min_data)
+            # same as (2x - (max + min)) / (max - min), but in place without full-size temporaries
+            self.full_data *= np.float32(2.0 / self.min_max_diff)
+            self.full_data -= np.float32((max_data + min_data) / self.min_max_diff)
 
         self._create_feature_vector(self.full_data, poi_data, len_closeness, len_period, len_trend, T_closeness, T_period, T_trend)
 
@@ -137,11 +145,20 @@ class BikeNYCDeepSTN(Dataset):
 
 
     def _get_path(self, root_dir):
+        root_dir = os.path.abspath(root_dir)
+        cached_dir = BikeNYCDeepSTN._data_dirs.get(root_dir)
+        if cached_dir is not None:
+            # the files may have been moved or deleted since they were found
+            if os.path.isfile(cached_dir + "/flow_data.npy") and os.path.isfile(cached_dir + "/poi_data.npy"):
+                return cached_dir
+            del BikeNYCDeepSTN._data_dirs[root_dir]
+
         queue = [root_dir]
         while queue:
             data_dir = queue.pop(0)
             folders = os.listdir(data_dir)
             if "flow_data.npy" in folders and "poi_data.npy" in folders:
+                BikeNYCDeepSTN._data_dirs[root_dir] = data_dir
                 return data_dir
 
             for folder in folders:
@@ -157,14 +174,14 @@ class BikeNYCDeepSTN(Dataset):
 
         time=np.arange(len_total,dtype=int)
         time_hour=time%T_period
-        matrix_hour=np.zeros([len_total,24,map_height,map_width])
-        for i in range(len_total):
-            matrix_hour[i,time_hour[i],:,:]=1
+        matrix_hour=np.zeros([len_total,24,1,1],dtype=np.float32)
+        matrix_hour[time,time_hour]=1
+        matrix_hour=np.broadcast_to(matrix_hour,(len_total,24,map_height,map_width))
 
         time_day=(time//T_period)%7
-        matrix_day=np.zeros([len_total,7,map_height,map_width])
-        for i in range(len_total):
-            matrix_day[i,time_day[i],:,:]=1
+        matrix_day=np.zeros([len_total,7,1,1],dtype=np.float32)
+        matrix_day[time,time_day]=1
+        matrix_day=np.broadcast_to(matrix_day,(len_total,7,map_height,map_width))
 
         matrix_T=np.concatenate((matrix_hour,matrix_day),axis=1)
 
@@ -180,17 +197,11 @@ class BikeNYCDeepSTN(Dataset):
         Y=all_data[number_of_skip_hours:len_total]
 
         if len_closeness>0:
-            self.X_closeness=all_data[number_of_skip_hours-T_closeness:len_total-T_closeness]
-            for i in range(len_closeness-1):
-                self.X_closeness=np.concatenate((self.X_closeness,all_data[number_of_skip_hours-T_closeness*(2+i):len_total-T_closeness*(2+i)]),axis=1)
+            self.X_closeness=np.concatenate([all_data[number_of_skip_hours-T_closeness*(k+1):len_total-T_closeness*(k+1)] for k in range(len_closeness)],axis=1)
         if len_period>0:
-            self.X_period=all_data[number_of_skip_hours-T_period:len_total-T_period]
-            for i in range(len_period-1):
-                self.X_period=np.concatenate((self.X_period,all_data[number_of_skip_hours-T_period*(2+i):len_total-T_period*(2+i)]),axis=1)
+            self.X_period=np.concatenate([all_data[number_of_skip_hours-T_period*(k+1):len_total-T_period*(k+1)] for k in range(len_period)],axis=1)
         if len_trend>0:
-            self.X_trend=all_data[number_of_skip_hours-T_trend:len_total-T_trend]
-            for i in range(len_trend-1):
-                self.X_trend=np.concatenate((self.X_trend,all_data[number_of_skip_hours-T_trend*(2+i):len_total-T_trend*(2+i)]),axis=1)
+            self.X_trend=np.concatenate([all_data[number_of_skip_hours-T_trend*(k+1):len_total-T_trend*(k+1)] for k in range(len_trend)],axis=1)
 
         matrix_T=matrix_T[number_of_skip_hours:]
 
@@ -199,14 +210,13 @@ class BikeNYCDeepSTN(Dataset):
 
         len_data=self.X_closeness.shape[0]
 
-        for i in range(poi.shape[0]):
-            poi[i]=poi[i]/np.max(poi[i])
-        self.P_data=np.repeat(poi.reshape(1,poi.shape[0],map_height,map_width),len_data,axis=0)
+        poi=poi/np.max(poi,axis=(1,2),keepdims=True)
 
-        self.X_closeness = torch.tensor(self.X_closeness)
-        self.X_period = torch.tensor(self.X_period)
-        self.X_trend = torch.tensor(self.X_trend)
-        self.T_data = torch.tensor(self.T_data)
-        self.P_data = torch.tensor(self.P_data)
-        self.Y_data = torch.tensor(self.Y_data)
+        self.X_closeness = torch.from_numpy(np.ascontiguousarray(self.X_closeness, dtype=np.float32))
+        self.X_period = torch.from_numpy(np.ascontiguousarray(self.X_period, dtype=np.float32))
+        self.X_trend = torch.from_numpy(np.ascontiguousarray(self.X_trend, dtype=np.float32))
+        self.T_data = torch.from_numpy(np.ascontiguousarray(self.T_data, dtype=np.float32))
+        # every sample shares the same POI tile, so expose it as a zero-copy expanded view
+        self.P_data = torch.from_numpy(np.ascontiguousarray(poi, dtype=np.float32)).unsqueeze(0).expand(len_data, -1, -1, -1)
+        self.Y_data = torch.from_numpy(np.ascontiguousarray(self.Y_data, dtype=np.float32))
 
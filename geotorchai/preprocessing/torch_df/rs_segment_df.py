@@ -3,7 +3,7 @@ from pyspark.sql.types import *
 import numpy as np
 from functools import partial
 from petastorm import TransformSpec
-from torchvision import transforms
+import torch
 from geotorchai.preprocessing.sedona_registration import SedonaRegistration
 
 
@@ -18,20 +18,37 @@ class RasterSegmentationDf:
 
     @classmethod
     def __transform_row(cls, batch_data, n_bands, height, width, transform=None):
-        transformers = [transforms.Lambda(lambda x: x.reshape((n_bands, height, width)))]
-        if transform is not None:
-            transformers.extend([transforms.ToTensor(), transform])
-        trans = transforms.Compose(transformers)
+        if len(batch_data) == 0:
+            return batch_data
 
-        transformers_label = [transforms.Lambda(lambda x: x.reshape((height, width)))]
-        trans_label = transforms.Compose(transformers_label)
+        # stack the whole row group once so that reshaping and casting are single vectorized operations
+        image_data = np.stack(batch_data['image_data'].values).astype(np.float32, copy=False).reshape(-1, n_bands, height, width)
+        label = np.stack(batch_data['label'].values).astype(np.int32, copy=False).reshape(-1, height, width)
 
-        batch_data['image_data'] = batch_data['image_data'].map(lambda x: trans(x))
-        batch_data['label'] = batch_data['label'].map(lambda x: trans_label(x))
+        if transform is not None:
+            batch_data['image_data'] = [transform(torch.from_numpy(x)) for x in image_data]
+        else:
+            batch_data['image_data'] = list(image_data)
+        batch_data['label'] = list(label)
         return batch_data
 
 
     def get_formatted_df(self):
+        if not isinstance(self.df_raster.schema[self.col_label].dataType, ArrayType):
+            return self.__get_formatted_df_from_rdd()
+
+        # thresholding with a native higher-order function keeps the rows in the JVM instead of round-tripping through Python
+        if self.is_label_masked:
+            label = col(self.col_label).cast(ArrayType(IntegerType()))
+        else:
+            label = expr("transform(`{0}`, x -> CAST(IF(x >= {1}, 1, 0) AS INT))".format(self.col_label, self.masking_threshold))
+
+        formatted_df = self.df_raster.select(col(self.col_data).cast(ArrayType(DoubleType())).alias("image_data"), label.alias("label"))
+
+        return formatted_df
+
+
+    def __get_formatted_df_from_rdd(self):
         spark = SedonaRegistration._get_sedona_context()
 
         df_schema = StructType(
@@ -1,4 +1,5 @@
 from geotorchai.datasets.grid import BikeNYCDeepSTN, TaxiBJ21
+import torch
 
 
 class TestGridDatasets:
@@ -33,6 +34,18 @@ class TestGridDatasets:
 		assert sample[0] == 2 and sample[1] == 21 and sample[2] == 12
 
 
+	def test_bike_nyc_deepstn_dataset_dtype(self):
+		data = BikeNYCDeepSTN(root = "data/partial_datasets/grid1")
+		sample = data[0]
+		assert all(sample[key].dtype == torch.float32 for key in sample)
+
+
+	def test_bike_nyc_deepstn_dataset_batch_index(self):
+		data = BikeNYCDeepSTN(root = "data/partial_datasets/grid1")
+		sample = data[[0, 1, 2]]
+		assert sample["x_closeness"].shape == torch.Size([3, 6, 21, 12]) and sample["p_data"].shape == torch.Size([3, 9, 21, 12])
+
+
 	def test_taxi_bj21_dataset_length(self):
 		data = TaxiBJ21(root = "data/partial_datasets/grid2")
 		data.set_sequential_representation(24, 1)
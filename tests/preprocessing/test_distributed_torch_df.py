@@ -2,7 +2,7 @@ from pyspark.sql.functions import lit
 import torch
 from tests.preprocessing.test_sedona_registration import TestSedonaRegistration
 from geotorchai.preprocessing import load_geotiff_image_as_binary_data, load_parquet_data
-from geotorchai.preprocessing.torch_df import RasterClassificationDf
+from geotorchai.preprocessing.torch_df import RasterClassificationDf, RasterSegmentationDf
 from geotorchai.preprocessing.torch_df import SpatiotemporalDfToTorchData
 from geotorchai.preprocessing.raster import RasterProcessing as rp
 
@@ -42,6 +42,15 @@ class TestRasterTransform:
 		assert formatted_df.select("image_data").first()[0][0] == 1151.0
 
 
+	def test_segment_formatted_df_label_threshold(self):
+		TestSedonaRegistration.set_sedona_context()
+
+		df_data = TestSedonaRegistration.sedona.createDataFrame([([1.0, 2.0, 3.0], [0, 255, 300])], ["image_data", "mask"])
+
+		formatted_df = RasterSegmentationDf(df_data, "image_data", "mask", is_label_masked=False).get_formatted_df()
+		assert formatted_df.select("label").first()[0] == [0, 1, 1]
+
+
 	def test_st_prediction_formatted_df_periodical_length(self):
 		TestSedonaRegistration.set_sedona_context()
 